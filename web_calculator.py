@@ -1,22 +1,25 @@
 # --- 1. Import Libraries ---
 import streamlit as st
 import pandas as pd
-from io import StringIO
+import numpy as np
 from datetime import datetime
+from zoneinfo import ZoneInfo
 import os
+import atexit
+import re
 import traceback
-import pytz
+import threading
+from functools import lru_cache
+from collections import namedtuple
 import sqlite3 # Import for SQLite
-
-# --- Import Selenium for advanced web scraping ---
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import requests
+import lxml.html
+from lxml import etree
 import arabic_reshaper
 from bidi.algorithm import get_display
 
+# --- Selenium (advanced web scraping) is imported inside the browser fallback; it is heavy and rarely needed ---
+
 
 # --- 2. Define Constants and Helper Functions ---
 TENOR_COLUMN_NAME = "المدة (الأيام)"
@@ -24,11 +27,43 @@ YIELD_COLUMN_NAME = "متوسط العائد المرجح المقبول (%)"
 DATE_COLUMN_NAME = "تاريخ العطاء"
 DB_FILENAME = "cbe_historical_data.db" # SQLite database file
 TABLE_NAME = "cbe_bids"
+FETCH_META_TABLE_NAME = "cbe_fetch_meta" # Provenance of the last successful fetch
+PARSER_VERSION = "lxml-2" # Bump when the parsing logic changes to invalidate stored data
+DATA_CACHE_TTL_SECONDS = 43200 # 12 hours
+PAGE_CACHE_TTL_SECONDS = 3600 # The page itself may change hourly; auctions change weekly
 CBE_DATA_URL = "https://www.cbe.org.eg/ar/auctions/egp-t-bills"
+YIELD_ROW_ANCHOR = "متوسط العائد المرجح (%)" # First-cell text of the yields row
+# JS snippet returning the outerHTML of every table on the page (one WebDriver round-trip)
+TABLES_HTML_SCRIPT = "return Array.from(document.querySelectorAll('table'), t => t.outerHTML).join('');"
+# Precompiled XPath lookups: tables with data cells, and tables whose rows start with the anchor text
+DATA_TABLES_XPATH = etree.XPath("//table[.//td]")
+ANCHOR_TABLES_XPATH = etree.XPath("//table[.//tr/*[1][contains(., $anchor)]]")
+# Within a table: first cell of every data row (header rows are <th> only), the anchored row, a row's cells
+TENOR_CELLS_XPATH = etree.XPath(".//tr[td]/*[1]")
+YIELD_ROW_XPATH = etree.XPath(".//tr[td][*[1][contains(., $anchor)]]")
+ROW_CELLS_XPATH = etree.XPath("./th|./td")
+TENOR_DAYS_RE = re.compile(r"(\d+)") # Day count inside a tenor cell, e.g. "91" or "91 يوم"
 
 # --- NEW: Centralized Constants ---
 DAYS_IN_YEAR = 365
+PERCENT_YEAR_TO_DAILY = 1.0 / (100.0 * DAYS_IN_YEAR) # Turns an annual % yield into a per-day decimal rate
 DEFAULT_TAX_RATE_PERCENT = 20.0
+TENOR_ICONS = {91: "⏳", 182: "🗓️", 273: "📆", 364: "🗓️✨"}
+CAIRO_TZ = ZoneInfo("Africa/Cairo")
+
+# Parsed auction rates as plain tuples: cheap for st.cache_data to store and copy
+CBERates = namedtuple("CBERates", ["tenors", "yields"])
+# A fetched CBE page; html is None when the server answered 304 Not Modified
+CBEPage = namedtuple("CBEPage", ["html", "etag", "last_modified"])
+# The process-wide SQLite connection and the lock that serializes its use across threads
+SQLiteHandle = namedtuple("SQLiteHandle", ["conn", "lock"])
+# Calculator results: immutable and cheaper to build than dicts
+PrimaryYieldResult = namedtuple("PrimaryYieldResult", ["gross_return", "tax_amount", "net_return", "total_payout"])
+SecondarySaleResult = namedtuple(
+    "SecondarySaleResult",
+    ["sale_price", "gross_profit", "tax_amount", "net_profit", "annualized_yield", "original_purchase_price", "error"],
+    defaults=(None,) * 7
+)
 
 # بيانات أولية في حالة عدم توفر ملف
 INITIAL_DATA = {
@@ -36,165 +71,469 @@ INITIAL_DATA = {
     YIELD_COLUMN_NAME: [26.914, 27.151, 26.534, 24.994]
 }
 
-def prepare_arabic_text(text):
+ARABIC_RESHAPER_CONFIGURATION = {'delete_harakat': True, 'support_ligatures': True}
+
+@st.cache_resource(show_spinner=False) # Runs before st.set_page_config, so it must not render anything
+def get_arabic_text_preparer():
     """
-    Handles Arabic text shaping for correct display in Streamlit widgets.
+    Builds the memoized text-shaping function. Streamlit re-executes this script
+    on every rerun, so a module-level lru_cache would start empty each time;
+    holding it as a resource keeps one cache for the whole process.
     """
-    if text is None: return ""
-    try:
-        configuration = {'delete_harakat': True, 'support_ligatures': True}
-        reshaped_text = arabic_reshaper.reshape(str(text), configuration)
-        return get_display(reshaped_text)
-    except Exception:
-        return str(text)
+    @lru_cache(maxsize=1024)
+    def prepare_arabic_text(text):
+        """
+        Handles Arabic text shaping for correct display in Streamlit widgets.
+        """
+        if text is None: return ""
+        try:
+            reshaped_text = arabic_reshaper.reshape(str(text), ARABIC_RESHAPER_CONFIGURATION)
+            return get_display(reshaped_text)
+        except Exception:
+            return str(text)
+
+    return prepare_arabic_text
+
+prepare_arabic_text = get_arabic_text_preparer()
+
+# Arabic day names, shaped through the shared cache for the status card
+DAYS_AR_DISPLAY = {
+    day_en: prepare_arabic_text(day_ar)
+    for day_en, day_ar in {'Monday':'الإثنين','Tuesday':'الثلاثاء','Wednesday':'الأربعاء','Thursday':'الخميس','Friday':'الجمعة','Saturday':'السبت','Sunday':'الأحد'}.items()
+}
+
+def cell_texts(cells):
+    """Returns the stripped text content of each lxml table cell."""
+    return [cell.text_content().strip() for cell in cells]
 
 # --- NEW: SQLite Database Functions ---
+@st.cache_resource(show_spinner=False)
+def get_sqlite_handle():
+    """
+    Opens one SQLite connection for the whole process instead of one per query.
+    The page-load reads and the background save thread share it, so every use
+    must hold the handle's lock.
+    """
+    conn = sqlite3.connect(DB_FILENAME, check_same_thread=False)
+    # The lock serializes all access in this process, so WAL adds no read/write concurrency here.
+    # What it buys is cheaper commits: with NORMAL, a save appends to the -wal file and only
+    # syncs at checkpoints, which is safe for a cache of public data.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return SQLiteHandle(conn, threading.Lock())
+
 def init_sqlite_db():
     """Initializes the SQLite database and creates the table if it doesn't exist."""
-    conn = sqlite3.connect(DB_FILENAME)
-    cursor = conn.cursor()
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
-        "{DATE_COLUMN_NAME}" TEXT NOT NULL,
-        "{TENOR_COLUMN_NAME}" INTEGER NOT NULL,
-        "{YIELD_COLUMN_NAME}" REAL NOT NULL,
-        PRIMARY KEY ("{DATE_COLUMN_NAME}", "{TENOR_COLUMN_NAME}")
-    )
-    """)
-    conn.commit()
-    conn.close()
+    db = get_sqlite_handle()
+    with db.lock, db.conn:
+        db.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            "{DATE_COLUMN_NAME}" TEXT NOT NULL,
+            "{TENOR_COLUMN_NAME}" INTEGER NOT NULL,
+            "{YIELD_COLUMN_NAME}" REAL NOT NULL,
+            PRIMARY KEY ("{DATE_COLUMN_NAME}", "{TENOR_COLUMN_NAME}")
+        )
+        """)
+        db.conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {FETCH_META_TABLE_NAME} (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """)
     print(f"INFO: Database '{DB_FILENAME}' initialized and table '{TABLE_NAME}' is ready.")
 
-# --- MODIFIED: fetch_data_from_cbe to use SQLite ---
-@st.cache_data(ttl=43200)
-def fetch_data_from_cbe():
+# --- Fetching: browser page load and HTML parsing are cached independently ---
+@st.cache_resource(show_spinner=False)
+def get_http_session():
     """
-    Fetches the latest T-bill data from the CBE website, processes it,
-    and stores it in the SQLite database.
-    This version now uses SQLite instead of a CSV file.
+    Returns a keep-alive requests session that asks for compressed responses.
+    Cached as a resource so the TLS connection survives Streamlit reruns.
     """
-    print("🚀 INFO: Initializing fetching process...")
+    session = requests.Session()
+    session.headers.update({
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+        "Accept-Encoding": "gzip, deflate",
+    })
+    return session
+
+def fetch_cbe_html_over_http():
+    """
+    Tries a conditional HTTP GET of the CBE page and returns a CBEPage.
+    Its html is None if the page is unchanged since the stored fetch.
+    Returns None if the server-rendered markup does not parse into the
+    tenors and yields tables (e.g. the page is rendered client-side).
+    """
+    fetch_metadata = load_fetch_metadata()
+    conditional_headers = {}
+    if fetch_metadata.get("etag"):
+        conditional_headers["If-None-Match"] = fetch_metadata["etag"]
+    if fetch_metadata.get("last_modified"):
+        conditional_headers["If-Modified-Since"] = fetch_metadata["last_modified"]
+
+    try:
+        response = get_http_session().get(CBE_DATA_URL, headers=conditional_headers, timeout=20)
+        if response.status_code == 304:
+            print("✅ INFO: CBE page not modified since the stored fetch.")
+            return CBEPage(None, fetch_metadata.get("etag"), fetch_metadata.get("last_modified"))
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"⚠️ INFO: Direct HTTP fetch failed ({e}), falling back to Selenium.")
+        return None
+
+    # The CBE site serves UTF-8; decoding directly skips requests' charset detection pass
+    page_source = response.content.decode("utf-8", errors="replace")
+    if YIELD_ROW_ANCHOR not in page_source:
+        print("⚠️ INFO: Yields table is not in the static HTML, falling back to Selenium.")
+        return None
+    # The anchor text alone is not enough: a client-rendered page can carry it in a
+    # script blob with no <table> at all. Only accept HTML the parser can read; the
+    # parse is cached by content, so the caller's later call is a cache hit.
+    try:
+        parse_cbe_tables(page_source)
+    except (ValueError, etree.LxmlError) as e:
+        print(f"⚠️ INFO: Static HTML has no usable yields table ({e}), falling back to Selenium.")
+        return None
+    return CBEPage(page_source, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+@st.cache_resource(show_spinner=False)
+def get_firefox_driver():
+    """
+    Starts one headless Firefox for the whole process. Launching geckodriver and
+    a fresh profile dominates the fallback's cost, so the browser is kept warm
+    between fetches and only shut down when the server exits.
+    """
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+
     options = Options()
     options.add_argument("--headless")
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
+    # Return at DOMContentLoaded; the explicit wait below covers the JS-rendered tables
+    options.page_load_strategy = "eager"
+    # Only the table text is read: skip images and web fonts (scripts stay on, they render the tables)
+    options.set_preference("permissions.default.image", 2)
+    options.set_preference("browser.display.use_document_fonts", 0)
+
+    driver = webdriver.Firefox(options=options)
+    driver.set_page_load_timeout(30)
+    atexit.register(driver.quit)
+    return driver
+
+@st.cache_data(ttl=PAGE_CACHE_TTL_SECONDS, max_entries=1, show_spinner=False)
+def fetch_cbe_tables_html():
+    """
+    Returns a CBEPage whose HTML contains the CBE auction tables: straight over
+    HTTP when the page is server-rendered, otherwise via headless Firefox.
+    Raises on failure so errors are never cached.
+    """
+    print("🚀 INFO: Initializing fetching process...")
+    page = fetch_cbe_html_over_http()
+    if page is not None:
+        return page
+
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException, WebDriverException
+
+    def discard_driver():
+        # The browser may have crashed; drop it so the next fetch starts a fresh one
+        print("🚪 INFO: Discarding the Selenium WebDriver after a browser error.")
+        get_firefox_driver.clear()
+        # Quit it now rather than at exit, so dead drivers do not pile up in atexit
+        atexit.unregister(driver.quit)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
 
-    driver = None
+    driver = get_firefox_driver()
     try:
-        driver = webdriver.Firefox(options=options)
-        driver.set_page_load_timeout(60)
         driver.get(CBE_DATA_URL)
 
-        data_anchor_text = "متوسط العائد المرجح (%)"
-        wait_xpath = f"//*[contains(text(), '{data_anchor_text}')]"
+        wait_xpath = f"//*[contains(text(), '{YIELD_ROW_ANCHOR}')]"
         
-        wait = WebDriverWait(driver, 45)
+        wait = WebDriverWait(driver, 20)
         wait.until(EC.presence_of_element_located((By.XPATH, wait_xpath)))
 
-        page_source = driver.page_source
-        all_dfs = pd.read_html(StringIO(page_source))
-
-        tenors_table = next((df for df in all_dfs if not df.empty), None)
-        if tenors_table is None or tenors_table.empty:
-            raise ValueError("Could not find the first table for tenors.")
-        tenors_list = tenors_table.iloc[:, 0].tolist()
-        
-        target_df = None
-        for df in all_dfs:
-            if not df.empty and df.to_string().find(data_anchor_text) != -1:
-                if df.iloc[:, 0].str.contains(data_anchor_text, regex=False, na=False).any():
-                    target_df = df.copy()
-
-        if target_df is None:
-            raise ValueError("Could not find any table containing the required yield data.")
-        
-        yield_row_df = target_df[target_df.iloc[:, 0].str.contains(data_anchor_text, regex=False, na=False)]
-        if yield_row_df.empty:
-            raise ValueError("Could not find the yield row in the target table.")
-
-        yields_list = yield_row_df.iloc[0, 1:].tolist()
-        if len(tenors_list) != len(yields_list):
-            raise ValueError(f"Data mismatch: Found {len(tenors_list)} tenors and {len(yields_list)} yields.")
-
-        initial_df = pd.DataFrame({
-            'المدة (الأيام)': tenors_list,
-            'العائد (%)': yields_list
-        })
-
-        initial_df['المدة (الأيام)'] = pd.to_numeric(initial_df['المدة (الأيام)'], errors='coerce')
-        initial_df['العائد (%)'] = pd.to_numeric(initial_df['العائد (%)'], errors='coerce')
-        initial_df.dropna(subset=['المدة (الأيام)', 'العائد (%)'], inplace=True)
-        initial_df['المدة (الأيام)'] = initial_df['المدة (الأيام)'].astype(int)
-
-        if 182 in initial_df['المدة (الأيام)'].values and 364 in initial_df['المدة (الأيام)'].values:
-            print("⚙️ INFO: Applying the observed mapping correction for 182 and 364 day tenors...")
-            yield_for_182_incorrect = initial_df.loc[initial_df['المدة (الأيام)'] == 182, 'العائد (%)'].iloc[0]
-            yield_for_364_incorrect = initial_df.loc[initial_df['المدة (الأيام)'] == 364, 'العائد (%)'].iloc[0]
-            
-            initial_df.loc[initial_df['المدة (الأيام)'] == 182, 'العائد (%)'] = yield_for_364_incorrect
-            initial_df.loc[initial_df['المدة (الأيام)'] == 364, 'العائد (%)'] = yield_for_182_incorrect
-            print("✅ INFO: Correction applied successfully.")
-        
-        final_df = initial_df.sort_values('المدة (الأيام)').reset_index(drop=True)
-        final_df.rename(columns={'العائد (%)': YIELD_COLUMN_NAME}, inplace=True)
-        final_df[DATE_COLUMN_NAME] = datetime.now().strftime("%Y-%m-%d")
+        # Only the <table> elements are ever inspected, so serialize just those
+        # in the browser instead of handing the whole page to the parser.
+        page_source = driver.execute_script(TABLES_HTML_SCRIPT)
+        # Park the warm browser on an empty page until the next fetch
+        driver.get("about:blank")
+    except TimeoutException:
+        # A slow CBE page, not a broken browser: keep it warm and park it for the next fetch
+        print("⏳ INFO: Timed out waiting for the CBE tables; keeping the browser for the next fetch.")
+        try:
+            driver.get("about:blank")
+        except WebDriverException:
+            discard_driver()
+        raise
+    except WebDriverException:
+        discard_driver()
+        raise
+
+    if not page_source:
+        raise ValueError("Could not find any tables on the CBE page.")
+    # The browser path has no HTTP validators to revalidate against later
+    return CBEPage(page_source, None, None)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def parse_cbe_tables(page_source):
+    """
+    Extracts the tenors and yields (sorted by tenor) from the CBE tables HTML
+    as a CBERates tuple. Pure function of its input, so results are cached by content.
+    """
+    # Locate the two tables with XPath and read only the cells we use:
+    # the tenor column of the first table and the single yields row.
+    tree = lxml.html.document_fromstring(page_source)
+    data_tables = DATA_TABLES_XPATH(tree)
+    if not data_tables:
+        raise ValueError("Could not find the first table for tenors.")
+    tenors_list = cell_texts(TENOR_CELLS_XPATH(data_tables[0]))
+
+    anchor_tables = ANCHOR_TABLES_XPATH(tree, anchor=YIELD_ROW_ANCHOR)
+    if not anchor_tables:
+        raise ValueError("Could not find any table containing the required yield data.")
+
+    yield_rows = YIELD_ROW_XPATH(anchor_tables[-1], anchor=YIELD_ROW_ANCHOR)
+    if not yield_rows:
+        raise ValueError("Could not find the yield row in the target table.")
+
+    yields_list = cell_texts(ROW_CELLS_XPATH(yield_rows[0])[1:])
+    if len(tenors_list) != len(yields_list):
+        raise ValueError(f"Data mismatch: Found {len(tenors_list)} tenors and {len(yields_list)} yields.")
+
+    # Build the frame straight from the extracted lists under the final column names;
+    # tenors are pulled out as ints here, rows without a day count are dropped.
+    parsed_rows = [
+        (int(tenor_match.group(1)), yield_text)
+        for tenor_match, yield_text in zip(map(TENOR_DAYS_RE.search, tenors_list), yields_list)
+        if tenor_match
+    ]
+    final_df = pd.DataFrame(parsed_rows, columns=[TENOR_COLUMN_NAME, YIELD_COLUMN_NAME])
+    final_df[YIELD_COLUMN_NAME] = pd.to_numeric(final_df[YIELD_COLUMN_NAME], errors='coerce')
+    final_df.dropna(inplace=True)
+    if final_df.empty:
+        raise ValueError("No tenor/yield rows could be parsed from the CBE tables.")
+
+    # One mask per tenor, computed once and reused for both the check and the swap
+    tenor_values = final_df[TENOR_COLUMN_NAME].to_numpy()
+    is_182, is_364 = tenor_values == 182, tenor_values == 364
+    if is_182.any() and is_364.any():
+        print("⚙️ INFO: Applying the observed mapping correction for 182 and 364 day tenors...")
+        yield_values = final_df[YIELD_COLUMN_NAME].to_numpy(copy=True)
+        yield_values[is_182], yield_values[is_364] = yield_values[is_364][0], yield_values[is_182][0]
+        final_df[YIELD_COLUMN_NAME] = yield_values
+        print("✅ INFO: Correction applied successfully.")
+    
+    final_df = final_df.sort_values(TENOR_COLUMN_NAME)
+    return CBERates(tuple(final_df[TENOR_COLUMN_NAME].tolist()), tuple(final_df[YIELD_COLUMN_NAME].tolist()))
 
-        # --- SQLite Database Insertion ---
-        conn = sqlite3.connect(DB_FILENAME)
-        cursor = conn.cursor()
-        
-        # Use INSERT OR REPLACE to add new data or update existing data for the same date/tenor
-        for index, row in final_df.iterrows():
-            cursor.execute(f"""
+def save_rates_to_db(final_df, etag=None, last_modified=None):
+    """
+    Stores a fetched rates DataFrame and its fetch provenance (including the
+    page's HTTP validators) in SQLite.
+    Runs on a background thread, so failures are logged rather than raised.
+    """
+    try:
+        # Fetch metadata must never be recorded without the rates it describes
+        if final_df.empty:
+            print("⚠️ WARNING: No rate rows to save; the stored data and fetch metadata are left unchanged.")
+            return
+        # Resolved before writing, so a committed save can never be logged as a failure
+        saved_date = final_df[DATE_COLUMN_NAME].iloc[0]
+        rate_rows = final_df[[DATE_COLUMN_NAME, TENOR_COLUMN_NAME, YIELD_COLUMN_NAME]].itertuples(index=False, name=None)
+        # Record where and when this data came from, so cold starts can reuse it
+        fetch_metadata = {
+            "fetched_at": datetime.now().isoformat(timespec="seconds"),
+            "source_url": CBE_DATA_URL,
+            "parser_version": PARSER_VERSION,
+            "etag": etag or "",
+            "last_modified": last_modified or "",
+        }
+
+        db = get_sqlite_handle()
+        # One transaction for the whole save: committed on success, rolled back on error
+        with db.lock, db.conn:
+            # Use INSERT OR REPLACE to add new data or update existing data for the same date/tenor
+            db.conn.executemany(f"""
                 INSERT OR REPLACE INTO {TABLE_NAME} (
                     "{DATE_COLUMN_NAME}", "{TENOR_COLUMN_NAME}", "{YIELD_COLUMN_NAME}"
                 ) VALUES (?, ?, ?)
-            """, (row[DATE_COLUMN_NAME], row[TENOR_COLUMN_NAME], row[YIELD_COLUMN_NAME]))
-        
-        conn.commit()
-        conn.close()
-        print(f"✅ INFO: Data for {final_df[DATE_COLUMN_NAME].iloc[0]} successfully saved to SQLite.")
+            """, rate_rows)
+            db.conn.executemany(
+                f"INSERT OR REPLACE INTO {FETCH_META_TABLE_NAME} (key, value) VALUES (?, ?)",
+                fetch_metadata.items()
+            )
+        print(f"✅ INFO: Data for {saved_date} successfully saved to SQLite.")
+    except Exception:
+        traceback.print_exc()
+        print("⚠️ WARNING: Saving the fetched rates to SQLite failed; new sessions will load the previously stored data.")
+
+def fetch_data_from_cbe():
+    """
+    Fetches the latest T-bill data from the CBE website, processes it,
+    and stores it in the SQLite database.
+    If the stored data is still fresh, it is returned without touching the network.
+    """
+    fresh_df, fetched_at = load_fresh_data()
+    if fresh_df is not None:
+        print(f"✅ INFO: Stored data from {fetched_at} is still fresh, skipping the CBE fetch.")
+        return fresh_df, 'SUCCESS', "البيانات المحفوظة حديثة بالفعل.", fetched_at[:10]
+
+    try:
+        page = fetch_cbe_tables_html()
+        if page.html is None:
+            # 304 Not Modified: the stored rates are current, just refresh their fetch time
+            stored_df, _ = load_data()
+            threading.Thread(target=save_rates_to_db, args=(stored_df.copy(), page.etag, page.last_modified), daemon=True).start()
+            return stored_df, 'SUCCESS', "لم تتغير البيانات منذ آخر تحديث.", datetime.now().strftime("%Y-%m-%d")
+
+        rates = parse_cbe_tables(page.html)
+        final_df = pd.DataFrame({TENOR_COLUMN_NAME: rates.tenors, YIELD_COLUMN_NAME: rates.yields})
+        final_df[DATE_COLUMN_NAME] = datetime.now().strftime("%Y-%m-%d")
+
+        # Persist off the critical path: the caller already has the DataFrame it needs
+        threading.Thread(target=save_rates_to_db, args=(final_df.copy(), page.etag, page.last_modified), daemon=True).start()
 
-        return final_df, 'SUCCESS', "تم تحديث البيانات بنجاح من الجدول الصحيح وحفظها!", datetime.now().strftime("%Y-%m-%d")
+        # The save has only been started here; its outcome is logged by save_rates_to_db
+        return final_df, 'SUCCESS', "تم تحديث البيانات بنجاح من الجدول الصحيح.", datetime.now().strftime("%Y-%m-%d")
 
     except Exception as e:
         traceback.print_exc()
         return None, 'ERROR', f"خطأ أثناء جلب البيانات: {e}", None
-    finally:
-        if driver:
-            print("🚪 INFO: Closing Selenium WebDriver.")
-            driver.quit()
 
-# --- MODIFIED: load_data to use SQLite ---
+# --- Loading Data from SQLite ---
+def db_modified_time():
+    """
+    Returns a marker that changes whenever the database is written, for use as
+    a cache key only. With WAL, recent writes sit in the -wal file until a
+    checkpoint, so both files are considered; opening the database also
+    touches the -wal file, so this is not the time the data was saved.
+    """
+    return max(os.path.getmtime(path) for path in (DB_FILENAME, DB_FILENAME + "-wal") if os.path.exists(path))
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def read_latest_rates(db_mtime):
+    """
+    Reads the rows for the most recent auction date, or None if the table is
+    empty. db_mtime is only the cache key: any write to the database changes
+    it, so reruns skip SQLite until new data is saved. Raises on failure so
+    errors are never cached.
+    """
+    # All records for the most recent date in one round trip; both the MAX()
+    # and the equality lookup are served by the (date, tenor) primary key
+    query = f"""
+        SELECT "{DATE_COLUMN_NAME}", "{TENOR_COLUMN_NAME}", "{YIELD_COLUMN_NAME}" FROM {TABLE_NAME}
+        WHERE "{DATE_COLUMN_NAME}" = (SELECT MAX("{DATE_COLUMN_NAME}") FROM {TABLE_NAME})
+    """
+    db = get_sqlite_handle()
+    with db.lock:
+        rows = db.conn.execute(query).fetchall()
+    if not rows:
+        return None
+    # A handful of typed rows: build the frame directly instead of going through read_sql_query
+    return pd.DataFrame(rows, columns=[DATE_COLUMN_NAME, TENOR_COLUMN_NAME, YIELD_COLUMN_NAME])
+
 def load_data():
     """Loads the latest data from the SQLite database."""
     if not os.path.exists(DB_FILENAME):
         return pd.DataFrame(INITIAL_DATA), "البيانات الأولية (قاعدة بيانات غير موجودة)"
 
     try:
-        conn = sqlite3.connect(DB_FILENAME)
-        # Find the most recent date in the database
-        latest_date_query = f'SELECT MAX("{DATE_COLUMN_NAME}") FROM {TABLE_NAME}'
-        latest_date = pd.read_sql_query(latest_date_query, conn).iloc[0, 0]
-
-        if latest_date is None:
-            conn.close()
+        db_mtime = db_modified_time()
+        latest_df = read_latest_rates(db_mtime)
+        if latest_df is None:
             return pd.DataFrame(INITIAL_DATA), "البيانات الأولية (قاعدة بيانات فارغة)"
-        
-        # Fetch all records for the most recent date
-        query = f'SELECT * FROM {TABLE_NAME} WHERE "{DATE_COLUMN_NAME}" = ?'
-        latest_df = pd.read_sql_query(query, conn, params=(latest_date,))
-        conn.close()
 
-        file_mod_time = os.path.getmtime(DB_FILENAME)
-        last_update = datetime.fromtimestamp(file_mod_time).strftime("%d-%m-%Y %H:%M")
-        
+        # Shown from the stored data, not the file times: opening the database
+        # in WAL mode touches the -wal file, which would read as "updated now"
+        fetched_at = load_fetch_metadata().get("fetched_at")
+        if fetched_at is not None:
+            last_update = datetime.fromisoformat(fetched_at).strftime("%d-%m-%Y %H:%M")
+        else:
+            last_update = datetime.fromisoformat(latest_df[DATE_COLUMN_NAME].max()).strftime("%d-%m-%Y")
         return latest_df, last_update
     except Exception as e:
         traceback.print_exc()
         return pd.DataFrame(INITIAL_DATA), f"خطأ في تحميل البيانات: {e}"
 
-# --- 3. Calculation Logic Functions (Unchanged) ---
+def load_fetch_metadata():
+    """
+    Returns the provenance recorded by the last successful fetch, or {} if
+    there is none or it came from another source URL or parser version.
+    """
+    if not os.path.exists(DB_FILENAME):
+        return {}
+
+    try:
+        db = get_sqlite_handle()
+        with db.lock:
+            fetch_metadata = dict(db.conn.execute(f"SELECT key, value FROM {FETCH_META_TABLE_NAME}").fetchall())
+    except sqlite3.Error:
+        traceback.print_exc()
+        return {}
+
+    if (fetch_metadata.get("source_url") != CBE_DATA_URL
+            or fetch_metadata.get("parser_version") != PARSER_VERSION):
+        return {}
+    return fetch_metadata
+
+def load_fresh_data():
+    """
+    Returns (DataFrame, fetched_at) for the stored data if the last successful
+    fetch is younger than the cache TTL. Returns (None, None) otherwise.
+    """
+    fetched_at = load_fetch_metadata().get("fetched_at")
+    if fetched_at is None:
+        return None, None
+
+    age_seconds = (datetime.now() - datetime.fromisoformat(fetched_at)).total_seconds()
+    if age_seconds >= DATA_CACHE_TTL_SECONDS:
+        return None, None
+
+    latest_df, _ = load_data()
+    return latest_df, fetched_at
+
+def rates_to_arrays(df):
+    """
+    Splits a rates DataFrame into two NumPy arrays (tenors, yields), sorted by
+    tenor with one entry per tenor (the first row wins).
+    """
+    if TENOR_COLUMN_NAME not in df.columns or YIELD_COLUMN_NAME not in df.columns:
+        return np.array([], dtype=np.int32), np.array([], dtype=np.float64)
+    unique_rates = df.drop_duplicates(TENOR_COLUMN_NAME).sort_values(TENOR_COLUMN_NAME)
+    return (unique_rates[TENOR_COLUMN_NAME].to_numpy(dtype=np.int32),
+            unique_rates[YIELD_COLUMN_NAME].to_numpy(dtype=np.float64))
+
+def request_rates_refresh():
+    """
+    on_click callback for the fetch button: only flags the request. The fetch
+    itself runs in the script body, because callbacks execute before this
+    run's namedtuples exist and st.cache_data could not pickle the results.
+    """
+    st.session_state.refresh_requested = True
+
+def refresh_rates_from_cbe():
+    """
+    Fetches the latest rates into session_state. Called near the top of the
+    script, before anything reads the rates, so the page renders the new data
+    in the same run and no second st.rerun() pass is needed.
+    """
+    with st.spinner(AR["fetch_spinner"]):
+        new_df, status, message, update_time = fetch_data_from_cbe()
+    if status == 'SUCCESS':
+        st.session_state.df_data = new_df
+        st.session_state.tenors, st.session_state.yields = rates_to_arrays(new_df)
+        st.session_state.last_update = datetime.now(CAIRO_TZ).strftime("%d-%m-%Y %H:%M")
+        st.toast(AR["fetch_success"], icon="✅")
+    else:
+        # Shown under the button on this run only
+        st.session_state.fetch_error = message
+
+# --- 3. Calculation Logic Functions ---
 
 def calculate_primary_yield(investment_amount, tenor, yield_rate, tax_rate):
     """
@@ -206,39 +545,117 @@ def calculate_primary_yield(investment_amount, tenor, yield_rate, tax_rate):
     tax_amount = gross_return * (tax_rate / 100.0)
     net_return = gross_return - tax_amount
     total_payout = investment_amount + net_return
-    return {
-        "gross_return": gross_return,
-        "tax_amount": tax_amount,
-        "net_return": net_return,
-        "total_payout": total_payout
-    }
+    return PrimaryYieldResult(gross_return, tax_amount, net_return, total_payout)
 
 def analyze_secondary_sale(face_value, original_yield, original_tenor, holding_days, secondary_yield, tax_rate):
     """
     Analyzes the outcome of selling a T-bill on the secondary market.
     Separates calculation logic from the UI.
     """
-    original_purchase_price = face_value / (1 + (original_yield / 100 * original_tenor / DAYS_IN_YEAR))
     remaining_days = original_tenor - holding_days
-    
     if remaining_days <= 0:
-        return {"error": "أيام الاحتفاظ يجب أن تكون أقل من أجل الإذن الأصلي."}
+        return SecondarySaleResult(error="أيام الاحتفاظ يجب أن تكون أقل من أجل الإذن الأصلي.")
 
-    sale_price = face_value / (1 + (secondary_yield / 100 * remaining_days / DAYS_IN_YEAR))
+    original_purchase_price = face_value / (1.0 + original_yield * original_tenor * PERCENT_YEAR_TO_DAILY)
+    sale_price = face_value / (1.0 + secondary_yield * remaining_days * PERCENT_YEAR_TO_DAILY)
     gross_profit = sale_price - original_purchase_price
     tax_amount = max(0, gross_profit * (tax_rate / 100.0))
     net_profit = gross_profit - tax_amount
-    annualized_yield = (net_profit / original_purchase_price) * (DAYS_IN_YEAR / holding_days) * 100 if holding_days > 0 else 0
+    annualized_yield = net_profit / (original_purchase_price * holding_days * PERCENT_YEAR_TO_DAILY) if holding_days > 0 else 0
     
-    return {
-        "error": None,
-        "sale_price": sale_price,
-        "gross_profit": gross_profit,
-        "tax_amount": tax_amount,
-        "net_profit": net_profit,
-        "annualized_yield": annualized_yield,
-        "original_purchase_price": original_purchase_price
-    }
+    return SecondarySaleResult(sale_price, gross_profit, tax_amount, net_profit, annualized_yield, original_purchase_price)
+
+# --- Static UI Labels (rebuilt each rerun from the per-process shaping cache; dynamic text calls prepare_arabic_text) ---
+AR = {
+    "fetch_spinner": prepare_arabic_text("جاري تشغيل المتصفح لجلب البيانات..."),
+    "fetch_success": prepare_arabic_text("✅ تم التحديث بنجاح!"),
+    "latest_yields": prepare_arabic_text("📊 أحدث العوائد المعتمدة"),
+    "data_missing": prepare_arabic_text("لم يتم تحميل البيانات أو أن البيانات غير مكتملة."),
+    "cbe_status": prepare_arabic_text("📡 حالة الاتصال بالبنك المركزي"),
+    "cairo_time": prepare_arabic_text("**التوقيت المحلي (القاهرة):**"),
+    "last_update": prepare_arabic_text("**آخر تحديث مسجل:**"),
+    "fetch_button": prepare_arabic_text("🔄 جلب أحدث البيانات"),
+    "open_cbe_site": prepare_arabic_text("🔗 فتح موقع البنك"),
+    "main_header": prepare_arabic_text("🧮 حاسبة العائد الأساسية"),
+    "main_step_inputs": prepare_arabic_text("1. أدخل بيانات الاستثمار"),
+    "investment_amount": prepare_arabic_text("المبلغ المستثمر (بالجنيه)"),
+    "select_tenor": prepare_arabic_text("اختر مدة الاستحقاق (بالأيام)"),
+    "tax_rate": prepare_arabic_text("نسبة الضريبة على الأرباح (%)"),
+    "main_step_calculate": prepare_arabic_text("2. قم بحساب العائد"),
+    "main_calculate_button": prepare_arabic_text("احسب العائد الآن"),
+    "yield_not_found": prepare_arabic_text("لم يتم العثور على عائد للأجل المحدد."),
+    "main_results_placeholder": prepare_arabic_text("✨ نتائج العائد الأساسي ستظهر هنا بعد ملء النموذج والضغط على زر الحساب."),
+    "secondary_header": prepare_arabic_text("⚖️ حاسبة البيع في السوق الثانوي"),
+    "secondary_step_original": prepare_arabic_text("1. أدخل بيانات الإذن الأصلي"),
+    "face_value": prepare_arabic_text("القيمة الإسمية للإذن"),
+    "original_yield": prepare_arabic_text("عائد الشراء الأصلي (%)"),
+    "original_tenor": prepare_arabic_text("أجل الإذن الأصلي (بالأيام)"),
+    "secondary_step_sale": prepare_arabic_text("2. أدخل تفاصيل البيع"),
+    "holding_days": prepare_arabic_text("أيام الاحتفاظ الفعلية (قبل البيع)"),
+    "secondary_market_yield": prepare_arabic_text("العائد السائد في السوق للمشتري (%)"),
+    "secondary_step_analyze": prepare_arabic_text("3. قم بتحليل قرار البيع"),
+    "secondary_calculate_button": prepare_arabic_text("حلل سعر البيع الثانوي"),
+    "secondary_results_title": prepare_arabic_text("✨ تحليل سعر البيع الثانوي"),
+    "sale_price": prepare_arabic_text("🏷️ سعر البيع الفعلي للإذن"),
+    "net_profit": prepare_arabic_text("💰 صافي الربح / الخسارة"),
+    "tax_details": prepare_arabic_text("تفاصيل حساب الضريبة"),
+    "taxable_profit": prepare_arabic_text("إجمالي الربح الخاضع للضريبة"),
+    "net_profit_after_tax": prepare_arabic_text("صافي الربح بعد الضريبة"),
+    "no_tax_on_losses": prepare_arabic_text("لا توجد ضريبة على الخسائر الرأسمالية."),
+    "secondary_results_placeholder": prepare_arabic_text("✨ أدخل بيانات البيع في النموذج لتحليل قرارك."),
+    "help_expander": prepare_arabic_text("💡 شرح ومساعدة (أسئلة شائعة)"),
+}
+
+# --- Static HTML Blocks (plain constants; the Arabic shaping inside them is cached per process) ---
+GLOBAL_STYLE_HTML = """<style> @import url('https://fonts.googleapis.com/css2?family=Cairo:wght@400;700&display=swap'); html, body, [class*="st-"], button, input, textarea, select { direction: rtl !important; text-align: right !important; font-family: 'Cairo', sans-serif !important; box-sizing: border-box; } h1, h2, h3, h4, h5, h6 { font-weight: 700 !important; } .main > div { background-color: #f0f2f6; } .st-emotion-cache-1r6slb0 { box-shadow: 0 4px 12px 0 rgba(0,0,0,0.1) !important; border-radius: 15px !important; border: 1px solid #495057 !important; padding: 25px !important; height: 100%; background-color: #343a40 !important; color: #f8f9fa !importante; } div[data-testid="stMetric"] { text-align: center; } div[data-testid="stMetricValue"] { color: #f8f9fa !important; font-size: 1.15rem !important; padding: 0 !important; margin: 0 !important; } div[data-testid="stMetricLabel"] { color: #adb5bd !important; font-size: 0.75rem !important; white-space: normal; word-wrap: break-word; padding: 0 !important; margin-top: 5px !important; } .app-title { text-align: center !important; padding: 1.5rem 1rem; background-color: #343a40; border-radius: 15px; margin-bottom: 1rem; box-shadow: 0 4px 12px 0 rgba(0,0,0,0.1) !important; } .app-title h1 { color: #ffffff !important; } .app-title p { color: #dee2e6 !important; } </style>"""
+
+HEADER_HTML = f""" <div class="app-title"> <h1>{prepare_arabic_text("🏦 حاسبة أذون الخزانة")}</h1> <p>{prepare_arabic_text("تطبيق تفاعلي لحساب وتحليل عوائد أذون الخزانة")}</p> </div> """
+
+# Main calculator results: the labels come from the shaping cache; only the amounts are formatted per render
+CURRENCY_AR = prepare_arabic_text("جنيه")
+NET_RETURN_HTML_TEMPLATE = f'<p style="font-size: 1.0rem; color: #adb5bd;">{prepare_arabic_text("العائد الصافي بعد الضريبة")}</p><p style="font-size: 2.0rem; color: #49c57a; font-weight: 700;">{{net_return:,.2f}} {CURRENCY_AR}</p>'
+RESULTS_TABLE_HTML_TEMPLATE = f'<table style="width:100%; font-size: 1.0rem;"><tr><td style="padding-bottom: 8px;">{prepare_arabic_text("💰 المبلغ المستثمر")}</td><td style="text-align:left;">{{investment_amount:,.2f}} {CURRENCY_AR}</td></tr><tr><td style="padding-bottom: 8px; color: #8ab4f8;">{prepare_arabic_text("📈 العائد الإجمالي")}</td><td style="text-align:left; color: #8ab4f8;">{{gross_return:,.2f}} {CURRENCY_AR}</td></tr><tr><td style="padding-bottom: 15px; color: #f28b82;">{{tax_label}}</td><td style="text-align:left; color: #f28b82;">- {{tax_amount:,.2f}} {CURRENCY_AR}</td></tr></table>'
+TOTAL_PAYOUT_HTML_TEMPLATE = f'<div style="background-color: #495057; padding: 10px; border-radius: 8px; display: flex; justify-content: space-between; align-items: center;"><span style="font-size: 1.1rem;">{prepare_arabic_text("🏦 إجمالي المستلم")}</span><span style="font-size: 1.2rem;">{{total_payout:,.2f}} {CURRENCY_AR}</span></div>'
+
+# Secondary-sale decision cards: fixed text comes from the shaping cache; only the amount sentence is shaped per render
+ADVICE_AR = prepare_arabic_text("النصيحة:")
+DECISION_PROFIT_HTML_TEMPLATE = f"""
+<div style="background-color: #1e4620; padding: 15px; border-radius: 8px; border: 1px solid #49c57a; text-align: right;">
+    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("✅ قرار البيع: مربح")}</h5>
+    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
+        {{amount_sentence}}
+        <br>
+        <small>{prepare_arabic_text("حدث هذا الربح لأن العائد السائد في السوق حالياً أقل من عائد شرائك الأصلي.")}</small>
+    </p>
+    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
+        <b>{ADVICE_AR}</b> {prepare_arabic_text("قد يكون البيع خياراً جيداً إذا كنت بحاجة للسيولة، أو وجدت فرصة استثمارية أخرى بعائد أعلى.")}
+    </p>
+</div>
+"""
+DECISION_LOSS_HTML_TEMPLATE = f"""
+<div style="background-color: #4a2a2a; padding: 15px; border-radius: 8px; border: 1px solid #f28b82; text-align: right;">
+    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("⚠️ قرار البيع: غير مربح")}</h5>
+    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
+        {{amount_sentence}}
+        <br>
+        <small>{prepare_arabic_text("حدثت هذه الخسارة لأن العائد السائد في السوق حالياً أعلى من عائد شرائك الأصلي.")}</small>
+    </p>
+    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
+        <b>{ADVICE_AR}</b> {prepare_arabic_text("يُنصح بالانتظار حتى تاريخ الاستحقاق لتجنب هذه الخسارة وتحقيق عائدك الأصلي.")}
+    </p>
+</div>
+"""
+DECISION_BREAK_EVEN_HTML = f"""
+<div style="background-color: #2a394a; padding: 15px; border-radius: 8px; border: 1px solid #8ab4f8; text-align: right;">
+    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("⚖️ قرار البيع: متعادل")}</h5>
+    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
+        {prepare_arabic_text("البيع الآن لن ينتج عنه أي ربح أو خسارة.")}
+    </p>
+    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
+        <b>{ADVICE_AR}</b> {prepare_arabic_text("يمكنك البيع إذا كنت بحاجة لاسترداد قيمة الشراء مبكراً دون أي تغيير في قيمتها.")}
+    </p>
+</div>
+"""
 
 # --- 4. Streamlit App Layout ---
 st.set_page_config(layout="wide", page_title="حاسبة أذون الخزانة", page_icon="🏦")
@@ -246,211 +663,175 @@ st.set_page_config(layout="wide", page_title="حاسبة أذون الخزانة
 # --- Initialize Database on App Start ---
 init_sqlite_db()
 
-# --- Global Style (Unchanged) ---
-st.markdown("""<style> @import url('https://fonts.googleapis.com/css2?family=Cairo:wght@400;700&display=swap'); html, body, [class*="st-"], button, input, textarea, select { direction: rtl !important; text-align: right !important; font-family: 'Cairo', sans-serif !important; box-sizing: border-box; } h1, h2, h3, h4, h5, h6 { font-weight: 700 !important; } .main > div { background-color: #f0f2f6; } .st-emotion-cache-1r6slb0 { box-shadow: 0 4px 12px 0 rgba(0,0,0,0.1) !important; border-radius: 15px !important; border: 1px solid #495057 !important; padding: 25px !important; height: 100%; background-color: #343a40 !important; color: #f8f9fa !importante; } div[data-testid="stMetric"] { text-align: center; } div[data-testid="stMetricValue"] { color: #f8f9fa !important; font-size: 1.15rem !important; padding: 0 !important; margin: 0 !important; } div[data-testid="stMetricLabel"] { color: #adb5bd !important; font-size: 0.75rem !important; white-space: normal; word-wrap: break-word; padding: 0 !important; margin-top: 5px !important; } .app-title { text-align: center !important; padding: 1.5rem 1rem; background-color: #343a40; border-radius: 15px; margin-bottom: 1rem; box-shadow: 0 4px 12px 0 rgba(0,0,0,0.1) !important; } .app-title h1 { color: #ffffff !important; } .app-title p { color: #dee2e6 !important; } </style>""", unsafe_allow_html=True)
+# --- Global Style ---
+st.markdown(GLOBAL_STYLE_HTML, unsafe_allow_html=True)
 
-# --- Header (Unchanged) ---
-st.markdown(f""" <div class="app-title"> <h1>{prepare_arabic_text("🏦 حاسبة أذون الخزانة")}</h1> <p>{prepare_arabic_text("تطبيق تفاعلي لحساب وتحليل عوائد أذون الخزانة")}</p> </div> """, unsafe_allow_html=True)
+# --- Header ---
+st.markdown(HEADER_HTML, unsafe_allow_html=True)
 
 # --- Data Loading ---
 if 'df_data' not in st.session_state:
     st.session_state.df_data, st.session_state.last_update = load_data()
-data_df = st.session_state.df_data
+    st.session_state.tenors, st.session_state.yields = rates_to_arrays(st.session_state.df_data)
+if st.session_state.pop("refresh_requested", False):
+    refresh_rates_from_cbe()
+
+# The column arrays are split once per data load; only the small lookup is rebuilt per rerun
+sorted_tenors = st.session_state.tenors.tolist()
+yield_by_tenor = dict(zip(sorted_tenors, st.session_state.yields.tolist()))
+tenor_options = sorted_tenors or [91, 182, 273, 364]
 
-# --- Top Row: Key Metrics & Update Section (Unchanged) ---
+# --- Top Row: Key Metrics & Update Section ---
 top_col1, top_col2 = st.columns(2, gap="large")
 
 with top_col1:
     with st.container(border=True):
-        st.subheader(prepare_arabic_text("📊 أحدث العوائد المعتمدة"), anchor=False)
-        if not data_df.empty and TENOR_COLUMN_NAME in data_df.columns and YIELD_COLUMN_NAME in data_df.columns:
-            sorted_tenors = sorted(data_df[TENOR_COLUMN_NAME].unique())
-            cols = st.columns(len(sorted_tenors) if sorted_tenors else 1)
-            tenor_icons = {91: "⏳", 182: "🗓️", 273: "📆", 364: "🗓️✨"}
-            for i, tenor in enumerate(sorted_tenors):
-                with cols[i]:
-                    icon = tenor_icons.get(tenor, "🪙")
-                    rate = data_df[data_df[TENOR_COLUMN_NAME] == tenor][YIELD_COLUMN_NAME].iloc[0]
+        st.subheader(AR["latest_yields"], anchor=False)
+        if yield_by_tenor:
+            cols = st.columns(len(sorted_tenors))
+            for col, tenor in zip(cols, sorted_tenors):
+                with col:
+                    icon = TENOR_ICONS.get(tenor, "🪙")
+                    rate = yield_by_tenor[tenor]
                     st.metric(label=prepare_arabic_text(f"{icon} أجل {tenor} يوم"), value=f"{rate:.3f}%")
         else:
-            st.warning(prepare_arabic_text("لم يتم تحميل البيانات أو أن البيانات غير مكتملة."))
+            st.warning(AR["data_missing"])
 
 with top_col2:
     with st.container(border=True):
-        st.subheader(prepare_arabic_text("📡 حالة الاتصال بالبنك المركزي"), anchor=False)
-        cairo_tz = pytz.timezone('Africa/Cairo')
-        now_cairo = datetime.now(cairo_tz)
-        days_ar = {'Monday':'الإثنين','Tuesday':'الثلاثاء','Wednesday':'الأربعاء','Thursday':'الخميس','Friday':'الجمعة','Saturday':'السبت','Sunday':'الأحد'}
+        st.subheader(AR["cbe_status"], anchor=False)
+        now_cairo = datetime.now(CAIRO_TZ)
         day_name_en = now_cairo.strftime('%A')
-        day_name_ar = days_ar.get(day_name_en, day_name_en)
+        day_name_ar = DAYS_AR_DISPLAY.get(day_name_en, day_name_en)
         current_time_str = now_cairo.strftime(f"%Y/%m/%d | %H:%M")
         
-        st.write(f"{prepare_arabic_text('**التوقيت المحلي (القاهرة):**')} {prepare_arabic_text(day_name_ar)}، {current_time_str}")
-        st.write(f"{prepare_arabic_text('**آخر تحديث مسجل:**')} {st.session_state.last_update}")
+        st.write(f"{AR['cairo_time']} {day_name_ar}، {current_time_str}")
+        st.write(f"{AR['last_update']} {st.session_state.last_update}")
         
-        if st.button(prepare_arabic_text("🔄 جلب أحدث البيانات"), use_container_width=True, type="primary"):
-            with st.spinner(prepare_arabic_text("جاري تشغيل المتصفح لجلب البيانات...")):
-                new_df, status, message, update_time = fetch_data_from_cbe()
-                if status == 'SUCCESS':
-                    st.session_state.df_data = new_df
-                    st.session_state.last_update = datetime.now(cairo_tz).strftime("%d-%m-%Y %H:%M")
-                    st.toast(prepare_arabic_text("✅ تم التحديث بنجاح!"), icon="✅")
-                    st.rerun() 
-                else:
-                    st.error(prepare_arabic_text(f"⚠️ {message}"), icon="⚠️")
+        st.button(AR["fetch_button"], use_container_width=True, type="primary", on_click=request_rates_refresh)
+        fetch_error = st.session_state.pop("fetch_error", None)
+        if fetch_error:
+            st.error(prepare_arabic_text(f"⚠️ {fetch_error}"), icon="⚠️")
         
-        st.link_button(prepare_arabic_text("🔗 فتح موقع البنك"), CBE_DATA_URL, use_container_width=True)
+        st.link_button(AR["open_cbe_site"], CBE_DATA_URL, use_container_width=True)
 
 st.divider()
 
-# --- Main Calculator Section (Unchanged) ---
-st.header(prepare_arabic_text("🧮 حاسبة العائد الأساسية"))
+# --- Main Calculator Section ---
+st.header(AR["main_header"])
 col_form_main, col_results_main = st.columns(2, gap="large")
 
 with col_form_main:
     with st.container(border=True):
-        st.subheader(prepare_arabic_text("1. أدخل بيانات الاستثمار"), anchor=False)
-        investment_amount_main = st.number_input(prepare_arabic_text("المبلغ المستثمر (بالجنيه)"), min_value=1000.0, value=100000.0, step=1000.0, key="main_investment")
+        # A form batches the inputs: the script reruns once on submit, not on every edit
+        with st.form("main_calc_form", border=False):
+            st.subheader(AR["main_step_inputs"], anchor=False)
+            investment_amount_main = st.number_input(AR["investment_amount"], min_value=1000.0, value=100000.0, step=1000.0, key="main_investment")
         
-        if TENOR_COLUMN_NAME in data_df.columns and not data_df[TENOR_COLUMN_NAME].empty:
-            options = sorted(data_df[TENOR_COLUMN_NAME].unique())
-            selected_tenor_main = st.selectbox(prepare_arabic_text("اختر مدة الاستحقاق (بالأيام)"), options=options, key="main_tenor")
-        else:
-            selected_tenor_main = st.selectbox(prepare_arabic_text("اختر مدة الاستحقاق (بالأيام)"), options=[91, 182, 273, 364], key="main_tenor")
+            selected_tenor_main = st.selectbox(AR["select_tenor"], options=tenor_options, key="main_tenor")
 
-        tax_rate_main = st.number_input(prepare_arabic_text("نسبة الضريبة على الأرباح (%)"), min_value=0.0, max_value=100.0, value=DEFAULT_TAX_RATE_PERCENT, step=0.5, format="%.1f", key="main_tax")
+            tax_rate_main = st.number_input(AR["tax_rate"], min_value=0.0, max_value=100.0, value=DEFAULT_TAX_RATE_PERCENT, step=0.5, format="%.1f", key="main_tax")
 
-        st.subheader(prepare_arabic_text("2. قم بحساب العائد"), anchor=False)
-        calculate_button_main = st.button(prepare_arabic_text("احسب العائد الآن"), use_container_width=True, type="primary", key="main_calc")
+            st.subheader(AR["main_step_calculate"], anchor=False)
+            calculate_button_main = st.form_submit_button(AR["main_calculate_button"], use_container_width=True, type="primary", key="main_calc")
 
 results_placeholder_main = col_results_main.empty()
 
 if calculate_button_main:
-    if not data_df.empty and TENOR_COLUMN_NAME in data_df.columns and YIELD_COLUMN_NAME in data_df.columns:
-        yield_rate_row = data_df[data_df[TENOR_COLUMN_NAME] == selected_tenor_main]
-        if not yield_rate_row.empty:
-            yield_rate = yield_rate_row[YIELD_COLUMN_NAME].iloc[0]
-            
+    if yield_by_tenor:
+        yield_rate = yield_by_tenor.get(selected_tenor_main)
+        if yield_rate is not None:
             results = calculate_primary_yield(investment_amount_main, selected_tenor_main, yield_rate, tax_rate_main)
             
             with results_placeholder_main.container(border=True):
                 st.subheader(prepare_arabic_text(f"✨ تفاصيل أجل {selected_tenor_main} يوم"), anchor=False)
-                st.markdown(f'<p style="font-size: 1.0rem; color: #adb5bd;">{prepare_arabic_text("العائد الصافي بعد الضريبة")}</p><p style="font-size: 2.0rem; color: #49c57a; font-weight: 700;">{results["net_return"]:,.2f} {prepare_arabic_text("جنيه")}</p>', unsafe_allow_html=True)
+                st.markdown(NET_RETURN_HTML_TEMPLATE.format(net_return=results.net_return), unsafe_allow_html=True)
                 st.markdown('<hr style="border-color: #495057;">', unsafe_allow_html=True)
-                st.markdown(f'<table style="width:100%; font-size: 1.0rem;"><tr><td style="padding-bottom: 8px;">{prepare_arabic_text("💰 المبلغ المستثمر")}</td><td style="text-align:left;">{investment_amount_main:,.2f} {prepare_arabic_text("جنيه")}</td></tr><tr><td style="padding-bottom: 8px; color: #8ab4f8;">{prepare_arabic_text("📈 العائد الإجمالي")}</td><td style="text-align:left; color: #8ab4f8;">{results["gross_return"]:,.2f} {prepare_arabic_text("جنيه")}</td></tr><tr><td style="padding-bottom: 15px; color: #f28b82;">{prepare_arabic_text(f"💸 ضريبة الأرباح ({tax_rate_main}%)")}</td><td style="text-align:left; color: #f28b82;">- {results["tax_amount"]:,.2f} {prepare_arabic_text("جنيه")}</td></tr></table>', unsafe_allow_html=True)
-                st.markdown(f'<div style="background-color: #495057; padding: 10px; border-radius: 8px; display: flex; justify-content: space-between; align-items: center;"><span style="font-size: 1.1rem;">{prepare_arabic_text("🏦 إجمالي المستلم")}</span><span style="font-size: 1.2rem;">{results["total_payout"]:,.2f} {prepare_arabic_text("جنيه")}</span></div>', unsafe_allow_html=True)
+                st.markdown(RESULTS_TABLE_HTML_TEMPLATE.format(
+                    investment_amount=investment_amount_main, gross_return=results.gross_return,
+                    tax_label=prepare_arabic_text(f"💸 ضريبة الأرباح ({tax_rate_main}%)"), tax_amount=results.tax_amount
+                ), unsafe_allow_html=True)
+                st.markdown(TOTAL_PAYOUT_HTML_TEMPLATE.format(total_payout=results.total_payout), unsafe_allow_html=True)
         else:
              with results_placeholder_main.container(border=True):
-                st.error(prepare_arabic_text("لم يتم العثور على عائد للأجل المحدد."))
+                st.error(AR["yield_not_found"])
 else:
     with results_placeholder_main.container(border=True):
-        st.info(prepare_arabic_text("✨ نتائج العائد الأساسي ستظهر هنا بعد ملء النموذج والضغط على زر الحساب."))
+        st.info(AR["main_results_placeholder"])
 
 
 # --- Secondary Market Sale Calculator (NOW FULLY UPGRADED) ---
 st.divider()
-st.header(prepare_arabic_text("⚖️ حاسبة البيع في السوق الثانوي"))
+st.header(AR["secondary_header"])
 col_secondary_form, col_secondary_results = st.columns(2, gap="large")
 
 with col_secondary_form:
     with st.container(border=True):
-        st.subheader(prepare_arabic_text("1. أدخل بيانات الإذن الأصلي"), anchor=False)
-        face_value_secondary = st.number_input(prepare_arabic_text("القيمة الإسمية للإذن"), min_value=1000.0, value=100000.0, step=1000.0, key="secondary_face_value")
-        original_yield_secondary = st.number_input(prepare_arabic_text("عائد الشراء الأصلي (%)"), min_value=1.0, value=29.0, step=0.1, key="secondary_original_yield", format="%.3f")
+        with st.form("secondary_calc_form", border=False):
+            st.subheader(AR["secondary_step_original"], anchor=False)
+            face_value_secondary = st.number_input(AR["face_value"], min_value=1000.0, value=100000.0, step=1000.0, key="secondary_face_value")
+            original_yield_secondary = st.number_input(AR["original_yield"], min_value=1.0, value=29.0, step=0.1, key="secondary_original_yield", format="%.3f")
         
-        if TENOR_COLUMN_NAME in data_df.columns and not data_df[TENOR_COLUMN_NAME].empty:
-            options = sorted(data_df[TENOR_COLUMN_NAME].unique())
-            original_tenor_secondary = st.selectbox(prepare_arabic_text("أجل الإذن الأصلي (بالأيام)"), options=options, key="secondary_tenor", index=0)
-        else:
-            original_tenor_secondary = st.selectbox(prepare_arabic_text("أجل الإذن الأصلي (بالأيام)"), options=[91, 182, 273, 364], key="secondary_tenor", index=0)
+            original_tenor_secondary = st.selectbox(AR["original_tenor"], options=tenor_options, key="secondary_tenor", index=0)
 
-        tax_rate_secondary = st.number_input(prepare_arabic_text("نسبة الضريبة على الأرباح (%)"), min_value=0.0, max_value=100.0, value=DEFAULT_TAX_RATE_PERCENT, step=0.5, format="%.1f", key="secondary_tax")
+            tax_rate_secondary = st.number_input(AR["tax_rate"], min_value=0.0, max_value=100.0, value=DEFAULT_TAX_RATE_PERCENT, step=0.5, format="%.1f", key="secondary_tax")
 
-        st.subheader(prepare_arabic_text("2. أدخل تفاصيل البيع"), anchor=False)
-        early_sale_days_secondary = st.number_input(prepare_arabic_text("أيام الاحتفاظ الفعلية (قبل البيع)"), min_value=1, value=min(60, original_tenor_secondary -1 if original_tenor_secondary > 1 else 1), max_value=original_tenor_secondary - 1 if original_tenor_secondary > 1 else 1, step=1)
-        secondary_market_yield = st.number_input(prepare_arabic_text("العائد السائد في السوق للمشتري (%)"), min_value=1.0, value=30.0, step=0.1, format="%.3f")
+            st.subheader(AR["secondary_step_sale"], anchor=False)
+            # The tenor above only reaches the script on submit, so bound by the longest tenor;
+            # analyze_secondary_sale rejects holding periods that exceed the chosen one
+            max_holding_days = max(max(tenor_options) - 1, 1)
+            early_sale_days_secondary = st.number_input(AR["holding_days"], min_value=1, value=min(60, max_holding_days), max_value=max_holding_days, step=1)
+            secondary_market_yield = st.number_input(AR["secondary_market_yield"], min_value=1.0, value=30.0, step=0.1, format="%.3f")
         
-        st.subheader(prepare_arabic_text("3. قم بتحليل قرار البيع"), anchor=False)
-        calc_secondary_sale_button = st.button(prepare_arabic_text("حلل سعر البيع الثانوي"), use_container_width=True, type="primary", key="secondary_calc")
+            st.subheader(AR["secondary_step_analyze"], anchor=False)
+            calc_secondary_sale_button = st.form_submit_button(AR["secondary_calculate_button"], use_container_width=True, type="primary", key="secondary_calc")
 
 secondary_results_placeholder = col_secondary_results.empty()
 
 if calc_secondary_sale_button:
     results = analyze_secondary_sale(face_value_secondary, original_yield_secondary, original_tenor_secondary, early_sale_days_secondary, secondary_market_yield, tax_rate_secondary)
 
-    if results["error"]:
-        secondary_results_placeholder.error(prepare_arabic_text(results["error"]))
+    if results.error:
+        secondary_results_placeholder.error(prepare_arabic_text(results.error))
     else:
         with secondary_results_placeholder.container(border=True):
-            st.subheader(prepare_arabic_text("✨ تحليل سعر البيع الثانوي"), anchor=False)
+            st.subheader(AR["secondary_results_title"], anchor=False)
             c1, c2 = st.columns(2)
-            c1.metric(label=prepare_arabic_text("🏷️ سعر البيع الفعلي للإذن"), value=f"{results['sale_price']:,.2f} جنيه")
-            c2.metric(label=prepare_arabic_text("💰 صافي الربح / الخسارة"), value=f"{results['net_profit']:,.2f} جنيه", delta=f"{results['annualized_yield']:.2f}% سنوياً")
+            c1.metric(label=AR["sale_price"], value=f"{results.sale_price:,.2f} جنيه")
+            c2.metric(label=AR["net_profit"], value=f"{results.net_profit:,.2f} جنيه", delta=f"{results.annualized_yield:.2f}% سنوياً")
             
             st.markdown('<hr style="border-color: #495057;">', unsafe_allow_html=True)
-            st.markdown(f"<h6 style='text-align:center; color:#dee2e6;'>{prepare_arabic_text('تفاصيل حساب الضريبة')}</h6>", unsafe_allow_html=True)
-            if results['gross_profit'] > 0:
-                 st.markdown(f""" <table style="width:100%; font-size: 0.9rem;  text-align:center;"> <tr> <td style="color: #8ab4f8;">{prepare_arabic_text('إجمالي الربح الخاضع للضريبة')}</td> <td style="color: #f28b82;">{prepare_arabic_text(f'قيمة الضريبة ({tax_rate_secondary}%)')}</td> <td style="color: #49c57a;">{prepare_arabic_text('صافي الربح بعد الضريبة')}</td> </tr> <tr> <td style="font-size: 1.1rem; color: #8ab4f8;">{results['gross_profit']:,.2f}</td> <td style="font-size: 1.1rem; color: #f28b82;">- {results['tax_amount']:,.2f}</td> <td style="font-size: 1.1rem; color: #49c57a;">{results['net_profit']:,.2f}</td> </tr> </table> """, unsafe_allow_html=True)
+            st.markdown(f"<h6 style='text-align:center; color:#dee2e6;'>{AR['tax_details']}</h6>", unsafe_allow_html=True)
+            if results.gross_profit > 0:
+                 st.markdown(f""" <table style="width:100%; font-size: 0.9rem;  text-align:center;"> <tr> <td style="color: #8ab4f8;">{AR["taxable_profit"]}</td> <td style="color: #f28b82;">{prepare_arabic_text(f'قيمة الضريبة ({tax_rate_secondary}%)')}</td> <td style="color: #49c57a;">{AR["net_profit_after_tax"]}</td> </tr> <tr> <td style="font-size: 1.1rem; color: #8ab4f8;">{results.gross_profit:,.2f}</td> <td style="font-size: 1.1rem; color: #f28b82;">- {results.tax_amount:,.2f}</td> <td style="font-size: 1.1rem; color: #49c57a;">{results.net_profit:,.2f}</td> </tr> </table> """, unsafe_allow_html=True)
             else:
-                 st.info(prepare_arabic_text("لا توجد ضريبة على الخسائر الرأسمالية."), icon="ℹ️")
+                 st.info(AR["no_tax_on_losses"], icon="ℹ️")
 
             # --- UPGRADED: Decision Card ---
             st.markdown('<hr style="border-color: #495057;">', unsafe_allow_html=True)
-            net_profit = results['net_profit']
+            net_profit = results.net_profit
             
             if net_profit > 0:
-                decision_html = f"""
-                <div style="background-color: #1e4620; padding: 15px; border-radius: 8px; border: 1px solid #49c57a; text-align: right;">
-                    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("✅ قرار البيع: مربح")}</h5>
-                    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
-                        {prepare_arabic_text(f"البيع الآن سيحقق لك <b>ربحاً صافياً</b> قدره <b>{net_profit:,.2f} جنيه</b>.")}
-                        <br>
-                        <small>{prepare_arabic_text("حدث هذا الربح لأن العائد السائد في السوق حالياً أقل من عائد شرائك الأصلي.")}</small>
-                    </p>
-                    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
-                        <b>{prepare_arabic_text("النصيحة:")}</b> {prepare_arabic_text("قد يكون البيع خياراً جيداً إذا كنت بحاجة للسيولة، أو وجدت فرصة استثمارية أخرى بعائد أعلى.")}
-                    </p>
-                </div>
-                """
-                st.markdown(decision_html, unsafe_allow_html=True)
+                decision_html = DECISION_PROFIT_HTML_TEMPLATE.format(
+                    amount_sentence=prepare_arabic_text(f"البيع الآن سيحقق لك <b>ربحاً صافياً</b> قدره <b>{net_profit:,.2f} جنيه</b>.")
+                )
             elif net_profit < 0:
                 loss_value = abs(net_profit)
-                decision_html = f"""
-                <div style="background-color: #4a2a2a; padding: 15px; border-radius: 8px; border: 1px solid #f28b82; text-align: right;">
-                    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("⚠️ قرار البيع: غير مربح")}</h5>
-                    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
-                        {prepare_arabic_text(f"البيع الآن سيتسبب في <b>خسارة صافية</b> قدرها <b>{loss_value:,.2f} جنيه</b>.")}
-                        <br>
-                        <small>{prepare_arabic_text("حدثت هذه الخسارة لأن العائد السائد في السوق حالياً أعلى من عائد شرائك الأصلي.")}</small>
-                    </p>
-                    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
-                        <b>{prepare_arabic_text("النصيحة:")}</b> {prepare_arabic_text("يُنصح بالانتظار حتى تاريخ الاستحقاق لتجنب هذه الخسارة وتحقيق عائدك الأصلي.")}
-                    </p>
-                </div>
-                """
-                st.markdown(decision_html, unsafe_allow_html=True)
+                decision_html = DECISION_LOSS_HTML_TEMPLATE.format(
+                    amount_sentence=prepare_arabic_text(f"البيع الآن سيتسبب في <b>خسارة صافية</b> قدرها <b>{loss_value:,.2f} جنيه</b>.")
+                )
             else: # net_profit is zero
-                decision_html = f"""
-                <div style="background-color: #2a394a; padding: 15px; border-radius: 8px; border: 1px solid #8ab4f8; text-align: right;">
-                    <h5 style="color: #ffffff; margin-bottom: 10px;">{prepare_arabic_text("⚖️ قرار البيع: متعادل")}</h5>
-                    <p style="color: #e0e0e0; font-size: 0.95rem; margin-bottom: 10px;">
-                        {prepare_arabic_text("البيع الآن لن ينتج عنه أي ربح أو خسارة.")}
-                    </p>
-                    <p style="color: #ffffff; font-size: 1rem; margin-bottom: 0;">
-                        <b>{prepare_arabic_text("النصيحة:")}</b> {prepare_arabic_text("يمكنك البيع إذا كنت بحاجة لاسترداد قيمة الشراء مبكراً دون أي تغيير في قيمتها.")}
-                    </p>
-                </div>
-                """
-                st.markdown(decision_html, unsafe_allow_html=True)
+                decision_html = DECISION_BREAK_EVEN_HTML
+            st.markdown(decision_html, unsafe_allow_html=True)
 
 else:
     with secondary_results_placeholder.container(border=True):
-        st.info(prepare_arabic_text("✨ أدخل بيانات البيع في النموذج لتحليل قرارك."))
+        st.info(AR["secondary_results_placeholder"])
 
 
-# --- Help Section (Unchanged) ---
+# --- Help Section ---
 st.divider()
-with st.expander(prepare_arabic_text("💡 شرح ومساعدة (أسئلة شائعة)")):
+with st.expander(AR["help_expander"]):
     st.markdown(prepare_arabic_text("""
     #### **ما الفرق بين "العائد" و "الفائدة"؟**
     - **الفائدة (Interest):** تُحسب على أصل المبلغ وتُضاف إليه دورياً (مثل شهادات الادخار).